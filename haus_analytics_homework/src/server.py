@@ -1,32 +1,33 @@
 import asyncio
-import collections
+import bisect
 import enum
-import json
-import socket
-import time
-from typing import Callable, Dict, List, Optional, Set
-
-
-def _get_now_in_seconds() -> float:
-    return time.time()
+import itertools
+import json.encoder
+from typing import Callable, ClassVar, Dict, Iterator, List, Optional
 
 
 class Record:
 
+    __slots__ = ('value', 'transaction_min', 'transaction_max')
+
     def __init__(
         self,
         value: str,
-        transaction_min: float,
-        transaction_max: float,
+        transaction_min: int,
+        transaction_max: int,
     ):
         self.value = value
         self.transaction_min = transaction_min
         self.transaction_max = transaction_max
 
     @classmethod
-    def for_insert(cls, value: str, transaction_min: float):
+    def for_insert(cls, value: str, transaction_min: int):
         return cls(value, transaction_min, 0)
 
+    @classmethod
+    def for_delete(cls, record: 'Record', transaction_max: int):
+        return cls(record.value, record.transaction_min, transaction_max)
+
     def __repr__(self):
         repr_ = ('{}('
                  'value="{}", '
@@ -38,325 +39,611 @@ class Record:
                             self.transaction_max)
 
 
+class VersionChain:
+
+    # Records are sorted by transaction_min, with ties in insertion order.
+    # tmins and tmaxes mirror records column-wise.
+    def __init__(self) -> None:
+        self.tmins: List[int] = []
+        self.tmaxes: List[int] = []
+        self.records: List[Record] = []
+        self.writes_since_compact = 0
+
+    def add(self, record: Record):
+        tmins = self.tmins
+        transaction_min = record.transaction_min
+        if not tmins or tmins[-1] <= transaction_min:
+            tmins.append(transaction_min)
+            self.tmaxes.append(record.transaction_max)
+            self.records.append(record)
+        else:
+            index = bisect.bisect_right(tmins, transaction_min)
+            tmins.insert(index, transaction_min)
+            self.tmaxes.insert(index, record.transaction_max)
+            self.records.insert(index, record)
+        self.writes_since_compact += 1
+
+    def compact(self, is_dead: Callable[[Record], bool], start: int = 0):
+        self.records = [
+            record
+            for record in itertools.islice(self.records, start, None)
+            if not is_dead(record)]
+        self.tmins = [record.transaction_min for record in self.records]
+        self.tmaxes = [record.transaction_max for record in self.records]
+        self.writes_since_compact = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        repr_ = ('{}(records={})')
+        return repr_.format(self.__class__.__name__, self.records)
+
+
 # See: https://www.sqlshack.com/sql-server-transaction-overview/
-class TransactionState(enum.Enum):
+class TransactionState(enum.IntEnum):
     ACTIVE = 0
     COMMITTED = 1
     ABORTED = 2
     ABORTED_FAILED = 3
 
 
+_ACTIVE = TransactionState.ACTIVE
+_COMMITTED = TransactionState.COMMITTED
+
+
 class Transaction:
 
+    __slots__ = ('created_at', 'state')
+
     def __init__(
         self,
-        created_at: Optional[float] = None,
+        created_at: int,
         state: TransactionState = TransactionState.ACTIVE,
-        _get_now_in_seconds: Callable[[], float] = _get_now_in_seconds,
     ):
-        self.created_at = (
-            created_at
-            if created_at is not None
-            else _get_now_in_seconds())
+        self.created_at = created_at
         self.state = state
 
-    def is_visible_to(self, curr_created_at: float) -> bool:
-        if self.state == TransactionState.ABORTED:
-            return False
-        if self.state == TransactionState.ABORTED_FAILED:
-            return False
-        within_txn = self.created_at == curr_created_at
-        is_visible_to = (
-            self.state == TransactionState.COMMITTED
-            and self.created_at < curr_created_at)
-        return within_txn or is_visible_to
+    def is_visible_to(self, curr_created_at: int) -> bool:
+        state = self.state
+        if state is _COMMITTED:
+            return self.created_at <= curr_created_at
+        return state is _ACTIVE and self.created_at == curr_created_at
 
     def __repr__(self):
         repr_ = ('{}(created_at={}, state={})')
         return repr_.format(self.__class__.__name__,
                             self.created_at,
-                            self.state)
-
+                            self.state.name)
 
-def implicit_transaction(func):
-    def inner(*args, **kwargs):
-        is_implicit = 'txn_id' not in kwargs or not kwargs['txn_id']
-        if not is_implicit:
-            return func(*args, **kwargs)
 
-        self = args[0]
-        txn_id = self.start_transaction()
-        kwargs['txn_id'] = txn_id
+def transactional(func):
+    def inner(self, *args, txn_id=None, _txn=None):
+        is_implicit = txn_id is None and _txn is None
+        if is_implicit:
+            txn_id = self.start_transaction()
+        txn = self._get_active_transaction(txn_id, _txn)
+        try:
+            result = func(self, *args, txn=txn)
+        except:
+            self._finish(txn, TransactionState.ABORTED_FAILED)
+            raise
+        if is_implicit:
+            self._finish(txn, TransactionState.COMMITTED)
+        return result
+    return inner
 
-        result = func(*args, **kwargs)
 
-        self.commit_transaction(txn_id=txn_id)
-        return result
+def read_only(func):
+    def inner(self, key, *, txn_id=None, _txn=None):
+        if txn_id is None and _txn is None:
+            return func(self, key, None)
+        txn = self._get_active_transaction(txn_id, _txn)
+        return func(self, key, txn.created_at)
     return inner
 
 
 def pre_transaction(func):
-    def inner(*args, **kwargs):
-        self = args[0]
-        txn_id = kwargs.get('txn_id', '')
-        if not txn_id:
-            raise ValueError('no active transaction')
-        txn = self._transactions.get(txn_id, None)
-        if txn is None:
-            raise LookupError('transaction ID {} not found'.format(txn_id))
-        if txn.state != TransactionState.ACTIVE:
-            raise ValueError('expected state for transaction ID {} to be {} but actually {}'.format(
-                txn_id,
-                TransactionState.ACTIVE,
-                txn.state,
-            ))
-        return func(*args, **kwargs)
+    def inner(self, *, txn_id=None, _txn=None):
+        txn = self._get_active_transaction(txn_id, _txn)
+        return func(self, txn=txn)
     return inner
 
 
-def post_transaction(func):
-    def inner(*args, **kwargs):
-        self = args[0]
-        txn_id = kwargs.get('txn_id', '')
-        try:
-            return func(*args, **kwargs)
-        except:
-            if txn_id:
-                self._transactions[txn_id].state = TransactionState.ABORTED_FAILED
-            raise
-    return inner
+# Returns the index of the version visible to txn_id, or -1 if none is.
+def find_visible(
+    tmins: List[int],
+    tmaxes: List[int],
+    transactions: Dict[int, Transaction],
+    txn_id: int,
+) -> int:
+    committed = _COMMITTED
+    index = bisect.bisect_right(tmins, txn_id) - 1
+    while index >= 0:
+        tmin = tmins[index]
+        # Transaction.is_visible_to inlined. Every insert left is at or
+        # before the snapshot, and the snapshot's own transaction is active,
+        # so the writer only has to have committed.
+        if transactions[tmin].state is not committed and tmin != txn_id:
+            # A writer's versions are contiguous, so the rest are skipped
+            # in one bisect.
+            index -= 1
+            if index >= 0 and tmins[index] == tmin:
+                index = bisect.bisect_left(tmins, tmin, 0, index) - 1
+            continue
+        tmax = tmaxes[index]
+        if tmax and transactions[tmax].is_visible_to(txn_id):
+            return -1
+        return index
+    return -1
+
+
+COMPACT_THRESHOLD: int = 32
+VACUUM_THRESHOLD: int = 1024
 
 
 class Server:
 
     def __init__(
         self,
-        database: Optional[collections.defaultdict[str, List[Record]]] = None,
-        transactions: Optional[Dict[float, Transaction]] = None,
-        _get_now_in_seconds: Callable[[], float] = _get_now_in_seconds,
+        database: Optional[Dict[str, VersionChain]] = None,
+        transactions: Optional[Dict[int, Transaction]] = None,
+        _next_txn_id: Optional[Iterator[int]] = None,
     ):
-        self._database = (
-            database
-            if database is not None
-            else collections.defaultdict(list))
+        self._database = database if database is not None else {}
         self._transactions = transactions if transactions is not None else {}
-        self._get_now_in_seconds = _get_now_in_seconds
-
-    @implicit_transaction
-    @pre_transaction
-    @post_transaction
-    def get(self, key: str, *, txn_id: float) -> Optional[str]:
-        record = self.get_record(key, txn_id=txn_id)
+        self._next_txn_id = (
+            _next_txn_id
+            if _next_txn_id is not None
+            else itertools.count(1))
+        self._latest: Dict[str, Record] = {}
+        self._finished_since_vacuum = 0
+        self._vacuum_threshold = VACUUM_THRESHOLD
+
+    @read_only
+    def get(self, key: str, txn_id: Optional[int]) -> Optional[str]:
+        record = self._get_record(key, txn_id)
         return record.value if record else None
 
-    @implicit_transaction
-    @pre_transaction
-    @post_transaction
-    def get_record(self, key: str, *, txn_id: float) -> Optional[Record]:
-        if not self._database[key]:
+    @read_only
+    def get_record(self, key: str, txn_id: Optional[int]) -> Optional[Record]:
+        return self._get_record(key, txn_id)
+
+    def _get_record(self, key: str, txn_id: Optional[int]) -> Optional[Record]:
+        if txn_id is None:
+            return self._get_latest(key)
+        chain = self._database.get(key, None)
+        if not chain:
             return None
-        for record in reversed(self._database[key]):
-            delete_txn = self._transactions.get(record.transaction_max, None)
-            insert_txn = self._transactions[record.transaction_min]
-            if delete_txn and delete_txn.is_visible_to(txn_id):
-                return None
-            if not insert_txn.is_visible_to(txn_id):
+        index = find_visible(chain.tmins, chain.tmaxes, self._transactions, txn_id)
+        return chain.records[index] if index >= 0 else None
+
+    # Without a snapshot, read the newest version whose insert committed,
+    # unless its delete did too. It is cached until the key is written,
+    # unless an active writer could still change it by committing.
+    def _get_latest(self, key: str) -> Optional[Record]:
+        record = self._latest.get(key, None)
+        if record is not None:
+            return record
+        chain = self._database.get(key, None)
+        if not chain:
+            return None
+        transactions = self._transactions
+        tmins = chain.tmins
+        active = _ACTIVE
+        committed = _COMMITTED
+        is_settled = True
+        for index in range(len(tmins) - 1, -1, -1):
+            state = transactions[tmins[index]].state
+            if state is not committed:
+                if state is active:
+                    is_settled = False
                 continue
+            tmax = chain.tmaxes[index]
+            if tmax:
+                state = transactions[tmax].state
+                if state is committed:
+                    return None
+                if state is active:
+                    is_settled = False
+            record = chain.records[index]
+            if is_settled:
+                self._latest[key] = record
             return record
         return None
 
-    @implicit_transaction
-    @pre_transaction
-    @post_transaction
-    def put(self, key: str, value: str, *, txn_id: float):
-        prev_record = self.get_record(key, txn_id=txn_id)
-        # update
-        if prev_record:
-            self.delete(key, txn_id=txn_id)
+    @transactional
+    def put(self, key: str, value: str, *, txn: Transaction):
+        self._latest.pop(key, None)
+        chain = self._database.get(key, None)
+        if chain is None:
+            chain = self._database[key] = VersionChain()
+        index = find_visible(chain.tmins, chain.tmaxes, self._transactions, txn.created_at)
+        if index < 0:
+            prev_record = None
+        else:
+            prev_record = chain.records[index]
+            if prev_record.value == value:
+                value = prev_record.value
+        record = Record.for_insert(value=value, transaction_min=txn.created_at)
+        if prev_record is not None:
+            if prev_record.transaction_min == txn.created_at:
+                chain.records[index] = record
+                return
+            # update
+            chain.add(Record.for_delete(prev_record, txn.created_at))
         # insert
-        record = Record.for_insert(value=value, transaction_min=txn_id)
-        self._database[key].append(record)
-
-    @implicit_transaction
-    @pre_transaction
-    @post_transaction
-    def delete(self, key: str, *, txn_id: float):
-        if not self._database[key]:
-            raise KeyError('key "{}" not found'.format(key))
+        chain.add(record)
+        self._maybe_compact(chain)
 
-        prev_record = self.get_record(key, txn_id=txn_id)
+    @transactional
+    def delete(self, key: str, *, txn: Transaction):
+        prev_record = self._get_record(key, txn.created_at)
         if prev_record is None:
             raise KeyError('key "{}" not found'.format(key))
-        record = Record(
-            value=prev_record.value,
-            transaction_min=prev_record.transaction_min,
-            transaction_max=txn_id,
-        )
-        self._database[key].append(record)
-
-    def start_transaction(self) -> float:
+        self._latest.pop(key, None)
+        record = Record.for_delete(prev_record, txn.created_at)
+        chain = self._database[key]
+        chain.add(record)
+        self._maybe_compact(chain)
+
+    def _maybe_compact(self, chain: VersionChain):
+        if len(chain) <= COMPACT_THRESHOLD:
+            return
+        if chain.writes_since_compact < len(chain) // 2:
+            return
+        chain.compact(self._is_aborted)
+
+    def _is_aborted(self, record: Record) -> bool:
+        state = self._transactions[record.transaction_min].state
+        return state >= TransactionState.ABORTED
+
+    def vacuum(self):
+        active = [
+            txn.created_at
+            for txn in self._transactions.values()
+            if txn.state is _ACTIVE]
+        if active:
+            horizon = min(active)
+        else:
+            horizon = max(self._transactions, default=0) + 1
+        for key, chain in list(self._database.items()):
+            chain.compact(self._is_aborted, self._find_oldest_visible(chain, horizon))
+            if not chain:
+                del self._database[key]
+                self._latest.pop(key, None)
+        referenced = set()
+        for chain in self._database.values():
+            referenced.update(chain.tmins)
+            referenced.update(chain.tmaxes)
+        for txn_id, txn in list(self._transactions.items()):
+            if txn.state is not _ACTIVE and txn_id not in referenced:
+                del self._transactions[txn_id]
+        self._finished_since_vacuum = 0
+        self._vacuum_threshold = max(
+            VACUUM_THRESHOLD,
+            len(self._database) + len(self._transactions))
+
+    # Every snapshot from the horizon on sees the newest version committed
+    # before it, so the scan never reaches the versions before that one. If
+    # it has also been deleted before the horizon, no one can see it either.
+    def _find_oldest_visible(self, chain: VersionChain, horizon: int) -> int:
+        transactions = self._transactions
+        tmins = chain.tmins
+        for index in range(bisect.bisect_left(tmins, horizon) - 1, -1, -1):
+            if transactions[tmins[index]].state is _COMMITTED:
+                tmax = chain.tmaxes[index]
+                if (tmax
+                        and transactions[tmax].state is _COMMITTED
+                        and tmax < horizon):
+                    return index + 1
+                return index
+        return 0
+
+    def _finish(self, txn: Transaction, state: TransactionState):
+        txn.state = state
+        self._finished_since_vacuum += 1
+        if self._finished_since_vacuum >= self._vacuum_threshold:
+            self.vacuum()
+
+    def start_transaction(self) -> int:
         txn = Transaction(
-            created_at=self._get_now_in_seconds(),
+            created_at=next(self._next_txn_id),
             state=TransactionState.ACTIVE)
         self._transactions[txn.created_at] = txn
         return txn.created_at
 
     @pre_transaction
-    def commit_transaction(self, *, txn_id: float):
-        txn = self._transactions.get(txn_id, None)
-        # This never occurs and is only for type checking.
-        if txn is None:
-            return
-        txn.state = TransactionState.COMMITTED
+    def commit_transaction(self, *, txn: Transaction):
+        self._finish(txn, TransactionState.COMMITTED)
 
     @pre_transaction
-    def rollback_transaction(self, *, txn_id: float):
+    def rollback_transaction(self, *, txn: Transaction):
+        self._finish(txn, TransactionState.ABORTED)
+
+    def get_transaction(self, txn_id: int) -> Transaction:
         txn = self._transactions.get(txn_id, None)
-        # This never occurs and is only for type checking.
         if txn is None:
-            return
-        txn.state = TransactionState.ABORTED
-
+            raise LookupError('transaction ID {} not found'.format(txn_id))
+        return txn
 
-DELIMITER: str = ' '
-COMMANDS: Set[str] = {
-    'GET',
-    'PUT',
-    'DELETE',
-    'START',
-    'COMMIT',
-    'ROLLBACK',
+    def _get_active_transaction(
+        self,
+        txn_id: Optional[int],
+        txn: Optional[Transaction] = None,
+    ) -> Transaction:
+        if txn is None:
+            if txn_id is None:
+                raise ValueError('no active transaction')
+            txn = self.get_transaction(txn_id)
+        if txn.state is not _ACTIVE:
+            raise ValueError('expected state for transaction ID {} to be {} but actually {}'.format(
+                txn.created_at,
+                TransactionState.ACTIVE.name,
+                txn.state.name,
+            ))
+        return txn
+
+
+DELIMITER: bytes = b' '
+TERMINATOR: bytes = b'\n'
+MAX_LINE_LENGTH: int = 64 * 1024
+MAX_VALUE_LENGTH: int = 1024 * 1024
+COMMANDS: Dict[bytes, str] = {
+    b'GET': 'GET',
+    b'PUT': 'PUT',
+    b'DELETE': 'DELETE',
+    b'START': 'START',
+    b'COMMIT': 'COMMIT',
+    b'ROLLBACK': 'ROLLBACK',
 }
+STATUS_OK: str = 'Ok'
+STATUS_ERROR: str = 'Error'
+
+RESPONSE_TEMPLATE: str = '{{"status": {}}}\n'
+RESPONSE_WITH_FIELD_TEMPLATE: str = '{{"status": {}, "{}": {}}}\n'
 
 
 class Request:
 
-    def __init__(self, command: str, key: str, value: str):
+    def __init__(self, command: str, key: str, value: str, length: int = 0):
         self.command = command
         self.key = key
         self.value = value
+        self.length = length
 
     def __repr__(self):
         repr_ = ('{}('
                  'command="{}", '
                  'key="{}", '
-                 'value="{}")')
+                 'value="{}", '
+                 'length={})')
         return repr_.format(self.__class__.__name__,
                             self.command,
                             self.key,
-                            self.value)
+                            self.value,
+                            self.length)
 
 
 class WebServer:
 
-    ENCODING = 'utf-8'
+    ENCODING: ClassVar[str] = 'utf-8'
+    HIGH_WATER: ClassVar[int] = 64 * 1024
 
     def __init__(self, server=None):
         self.server = server if server else Server()
+        self._handlers = {
+            'GET': self.do_get,
+            'PUT': self.do_put,
+            'DELETE': self.do_delete,
+            'START': self.do_start_transaction,
+            'COMMIT': self.do_commit_transaction,
+            'ROLLBACK': self.do_rollback_transaction,
+        }
         self.server.put('intro', 'Hello, World!')
 
-    async def handler(self, reader, writer):
-        request = None
-        session = {
+    def new_session(self):
+        return {
             'txn_id': None,
+            'txn': None,
+            'output': {},
         }
 
-        while request != 'quit':
-            raw_data = await reader.read(1024)
-            decoded = raw_data.decode(self.ENCODING)
-            request = self.parse(decoded)
-            session['output'] = {}
+    def respond(self, session, request: Optional[Request], raw_data: bytes) -> bytes:
+        output = session['output']
+        output.clear()
 
-            if not request or request.command not in COMMANDS:
-                session['output']['status'] = 'Error'
-                session['output']['mesg'] = 'invalid request "{}"'.format(decoded)
-            else:
-                try:
-                    if request.command == 'GET':
-                        self.do_get(session, request)
-                    if request.command == 'PUT':
-                        self.do_put(session, request)
-                    if request.command == 'DELETE':
-                        self.do_delete(session, request)
-                    if request.command == 'START':
-                        self.do_start_transaction(session, request)
-                    if request.command == 'COMMIT':
-                        self.do_commit_transaction(session, request)
-                    if request.command == 'ROLLBACK':
-                        self.do_rollback_transaction(session, request)
-                except Exception as error:
-                    session['output']['status'] = 'Error'
-                    session['output']['mesg'] = str(error)
-
-            stringified = json.dumps(session['output'], indent=2) + '\n'
-            encoded = stringified.encode(self.ENCODING)
-            writer.write(encoded)
-            await writer.drain()
-        writer.close()
+        if not request:
+            decoded = raw_data.decode(self.ENCODING, errors='replace')
+            output['status'] = STATUS_ERROR
+            output['mesg'] = 'invalid request "{}"'.format(decoded)
+        else:
+            try:
+                self._handlers[request.command](session, request)
+            except Exception as error:
+                output['status'] = STATUS_ERROR
+                output['mesg'] = str(error)
+
+        return self.format(output)
 
     def do_get(self, session, request):
-        result = self.server.get(request.key, txn_id=session['txn_id'])
+        result = self.server.get(request.key,
+                                 txn_id=session['txn_id'],
+                                 _txn=session['txn'])
         if result:
-            session['output']['status'] = 'Ok'
+            session['output']['status'] = STATUS_OK
             session['output']['result'] = result
         else:
             # TODO(duy): Change from returning None to raising KeyError.
-            session['output']['status'] = 'Error'
+            session['output']['status'] = STATUS_ERROR
             session['output']['mesg'] = 'key "{}" not found'.format(request.key)
 
     def do_put(self, session, request):
-        self.server.put(request.key, request.value, txn_id=session['txn_id'])
-        session['output']['status'] = 'Ok'
+        self.server.put(request.key,
+                        request.value,
+                        txn_id=session['txn_id'],
+                        _txn=session['txn'])
+        session['output']['status'] = STATUS_OK
 
     def do_delete(self, session, request):
-        self.server.delete(request.key, txn_id=session['txn_id'])
-        session['output']['status'] = 'Ok'
+        self.server.delete(request.key,
+                           txn_id=session['txn_id'],
+                           _txn=session['txn'])
+        session['output']['status'] = STATUS_OK
 
     def do_start_transaction(self, session, request):
         txn_id = self.server.start_transaction()
-        session['output']['status'] = 'Ok'
+        session['output']['status'] = STATUS_OK
         session['txn_id'] = txn_id
+        session['txn'] = self.server.get_transaction(txn_id)
 
     def do_commit_transaction(self, session, request):
-        txn_id = self.server.commit_transaction(txn_id=session['txn_id'])
-        session['output']['status'] = 'Ok'
+        txn_id = self.server.commit_transaction(txn_id=session['txn_id'],
+                                                 _txn=session['txn'])
+        session['output']['status'] = STATUS_OK
         session['txn_id'] = None
+        session['txn'] = None
 
     def do_rollback_transaction(self, session, request):
-        txn_id = self.server.rollback_transaction(txn_id=session['txn_id'])
-        session['output']['status'] = 'Ok'
+        txn_id = self.server.rollback_transaction(txn_id=session['txn_id'],
+                                                   _txn=session['txn'])
+        session['output']['status'] = STATUS_OK
         session['txn_id'] = None
+        session['txn'] = None
+
+    @classmethod
+    def format(cls, output: Dict[str, str]) -> bytes:
+        encode = json.encoder.encode_basestring_ascii
+        status = encode(output['status'])
+        for name in ('result', 'mesg'):
+            if name in output:
+                formatted = RESPONSE_WITH_FIELD_TEMPLATE.format(
+                    status,
+                    name,
+                    encode(output[name]))
+                break
+        else:
+            formatted = RESPONSE_TEMPLATE.format(status)
+        return formatted.encode(cls.ENCODING)
 
-    @staticmethod
-    def parse(request: str) -> Optional[Request]:
-        stripped = request.rstrip('\n')
-        if not stripped:
+    @classmethod
+    def parse(cls, request: bytes) -> Optional[Request]:
+        if not request:
             raise ValueError('no arguments specified')
-        arguments = stripped.split(DELIMITER, maxsplit=2)
-        command = arguments[0]
-        key, value = '', ''
-        if len(arguments) > 1:
-            key = arguments[1]
-        if len(arguments) > 2:
-            value = arguments[2]
-        if command == 'PUT' and not value:
+        arguments = request.split(DELIMITER, maxsplit=2)
+        command = COMMANDS.get(arguments[0], None)
+        if command is None:
             return None
+        key, length = '', 0
+        if len(arguments) > 1:
+            key = arguments[1].decode(cls.ENCODING)
+        if command == 'PUT':
+            if len(arguments) < 3 or not arguments[2].isdigit():
+                return None
+            length = int(arguments[2])
+            if not length:
+                return None
         if command == 'DELETE' and not key:
             return None
-        return Request(command=command, key=key, value=value)
+        return Request(command=command, key=key, value='', length=length)
 
+    @classmethod
+    def parse_value(cls, request: Request, value: bytes) -> Optional[Request]:
+        if not value.endswith(TERMINATOR):
+            return None
+        try:
+            request.value = value[:-len(TERMINATOR)].decode(cls.ENCODING)
+        except UnicodeDecodeError:
+            return None
+        return request
 
-def main_blocking():
-    web_server = WebServer()
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(('127.0.0.1', 5000))
-        server.listen(5)
+class Connection(asyncio.Protocol):
+
+    transport: asyncio.Transport
+
+    def __init__(self, web_server: WebServer):
+        self.web_server = web_server
+        self.session = web_server.new_session()
+        self.buffer = bytearray()
+        self.pending: Optional[Request] = None
+        self.pending_header = b''
+        self.scanned = 0
 
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WebServer.HIGH_WATER)
+
+    def data_received(self, data: bytes):
+        web_server = self.web_server
+        buffer = self.buffer
+        buffer += data
+        start = 0
+        responses: List[bytes] = []
         while True:
-            client_socket, client_address = server.accept()
-            web_server.handler(client_socket, client_address)
+            request = self.pending
+            if request is None:
+                end = buffer.find(TERMINATOR, start + self.scanned)
+                if end < 0:
+                    self.scanned = max(len(buffer) - start - len(TERMINATOR) + 1, 0)
+                    if len(buffer) - start > MAX_LINE_LENGTH:
+                        self.close(responses, 'request too long')
+                        return
+                    break
+                self.scanned = 0
+                if end - start > MAX_LINE_LENGTH:
+                    self.close(responses, 'request too long')
+                    return
+                raw_data = bytes(buffer[start:end])
+                start = end + len(TERMINATOR)
+                try:
+                    request = web_server.parse(raw_data)
+                except ValueError:
+                    request = None
+                if request and request.length > MAX_VALUE_LENGTH:
+                    self.close(responses, 'value too long')
+                    return
+                if request and request.length:
+                    self.pending = request
+                    self.pending_header = raw_data
+                    continue
+            else:
+                end = start + request.length + len(TERMINATOR)
+                if len(buffer) < end:
+                    break
+                raw_data = self.pending_header
+                request = web_server.parse_value(request, bytes(buffer[start:end]))
+                start = end
+                self.pending = None
+            responses.append(
+                web_server.respond(self.session, request, raw_data))
+        del buffer[:start]
+        if responses:
+            self.transport.writelines(responses)
+
+    def close(self, responses: List[bytes], mesg: str):
+        responses.append(self.web_server.format({
+            'status': STATUS_ERROR,
+            'mesg': mesg,
+        }))
+        self.transport.writelines(responses)
+        self.transport.close()
+        self.buffer.clear()
+        self.pending = None
+        self.scanned = 0
+
+    def connection_lost(self, exc):
+        txn = self.session['txn']
+        if txn is not None and txn.state is _ACTIVE:
+            self.web_server.server.rollback_transaction(txn_id=txn.created_at)
+        self.session['txn_id'] = None
+        self.session['txn'] = None
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
 
 
 async def main():
@@ -365,10 +652,25 @@ async def main():
     host = 'localhost'
     port = 5000
 
-    server = await asyncio.start_server(web_server.handler, host, port)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: Connection(web_server),
+        host,
+        port)
     async with server:
         await server.serve_forever()
 
 
+def run(coroutine):
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        return asyncio.run(coroutine)
+    if not hasattr(uvloop, 'run'):
+        uvloop.install()
+        return asyncio.run(coroutine)
+    return uvloop.run(coroutine)
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    run(main())
\ No newline at end of file
@@ -1,4 +1,7 @@
-import collections
+import itertools
+import json
+import sys
+import types
 
 import pytest
 
@@ -6,11 +9,17 @@ from .. import server as server_lib
 
 FOUND_KEY: str = 'found_key'
 FOUND_VALUE: str = 'found_value'
-EXISTING_RECORD: server_lib.Record = server_lib.Record(
-    value=FOUND_VALUE,
-    transaction_min=0.0,
-    transaction_max=0.0,
+ACTIVE: server_lib.TransactionState = server_lib.TransactionState.ACTIVE
+COMMITTED: server_lib.TransactionState = server_lib.TransactionState.COMMITTED
+ABORTED: server_lib.TransactionState = server_lib.TransactionState.ABORTED
+ABORTED_FAILED: server_lib.TransactionState = server_lib.TransactionState.ABORTED_FAILED
+# Transactions in these states can no longer be committed or rolled back.
+FINISHED_STATES: tuple[server_lib.TransactionState, ...] = (
+    COMMITTED,
+    ABORTED,
+    ABORTED_FAILED,
 )
+FINISHED_STATE_IDS: tuple[str, ...] = ('committed', 'aborted', 'aborted_failed')
 
 
 class TestRecord:
@@ -25,22 +34,78 @@ class TestRecord:
         assert record.transaction_min == transaction_min
         assert record.transaction_max == 0
 
+    def test_for_delete(self):
+        prev_record = server_lib.Record.for_insert('foo', 123)
+        transaction_max = 456
+
+        record = server_lib.Record.for_delete(prev_record, transaction_max)
+
+        assert record.value == prev_record.value
+        assert record.transaction_min == prev_record.transaction_min
+        assert record.transaction_max == transaction_max
+
+
+class TestVersionChain:
+
+    def test_add_sorted_by_transaction_min(self):
+        chain = server_lib.VersionChain()
+        newer = server_lib.Record.for_insert('newer', 2)
+        older = server_lib.Record.for_insert('older', 1)
+        deleted = server_lib.Record('older', 1, 3)
+
+        chain.add(newer)
+        chain.add(older)
+        chain.add(deleted)
+
+        assert chain.tmins == [1, 1, 2]
+        assert chain.tmaxes == [0, 3, 0]
+        assert chain.records == [older, deleted, newer]
+
+    def test_add_ties_in_insertion_order(self):
+        chain = server_lib.VersionChain()
+        records = [
+            server_lib.Record.for_insert('first', 1),
+            server_lib.Record('first', 1, 1),
+            server_lib.Record.for_insert('second', 1),
+        ]
+
+        for record in records:
+            chain.add(record)
+
+        assert chain.records == records
+
+    def test_compact(self):
+        chain = server_lib.VersionChain()
+        kept = server_lib.Record.for_insert('kept', 1)
+        dropped = server_lib.Record.for_insert('dropped', 2)
+        chain.add(kept)
+        chain.add(dropped)
+
+        chain.compact(lambda record: record is dropped)
+
+        assert chain.tmins == [1]
+        assert chain.tmaxes == [0]
+        assert chain.records == [kept]
+        assert chain.writes_since_compact == 0
+
 
 class TestTransaction:
 
     def test_state(self):
-        transaction = server_lib.Transaction()
-        assert transaction.state == server_lib.TransactionState.ACTIVE
+        transaction = server_lib.Transaction(created_at=1)
+        assert transaction.state == ACTIVE
 
     @pytest.mark.parametrize(
         'state, curr_created_at, expected',
         [
-            (server_lib.TransactionState.ACTIVE, 0, False),
-            (server_lib.TransactionState.ACTIVE, 5, True),
-            (server_lib.TransactionState.ACTIVE, 10, False),
-            (server_lib.TransactionState.COMMITTED, 0, False),
-            (server_lib.TransactionState.COMMITTED, 5, True),
-            (server_lib.TransactionState.COMMITTED, 10, True),
+            (ACTIVE, 0, False),
+            (ACTIVE, 5, True),
+            (ACTIVE, 10, False),
+            (COMMITTED, 0, False),
+            (COMMITTED, 5, True),
+            (COMMITTED, 10, True),
+            (ABORTED, 5, False),
+            (ABORTED_FAILED, 10, False),
         ],
         ids=[
             'active_less_than',
@@ -49,6 +114,8 @@ class TestTransaction:
             'committed_less_than',
             'committed_equal',
             'committed_greater_than',
+            'aborted_equal',
+            'aborted_failed_greater_than',
         ],
     )
     def test_is_visible_to(self, state, curr_created_at, expected):
@@ -56,21 +123,106 @@ class TestTransaction:
         assert transaction.is_visible_to(curr_created_at) is expected
 
 
+class TestFindVisible:
+
+    def setup_method(self):
+        self.transactions = {
+            1: server_lib.Transaction(created_at=1, state=COMMITTED),
+            2: server_lib.Transaction(created_at=2, state=COMMITTED),
+            3: server_lib.Transaction(created_at=3),
+        }
+        # 1 inserts, 2 updates, and 3 deletes without committing.
+        self.tmins = [1, 1, 2, 2]
+        self.tmaxes = [0, 2, 0, 3]
+
+    @pytest.mark.parametrize(
+        'txn_id, expected',
+        [
+            (1, 1),
+            (2, 3),
+            (3, -1),
+            (4, 3),
+        ],
+        ids=[
+            'before_update',
+            'after_update',
+            'within_delete',
+            'uncommitted_delete',
+        ],
+    )
+    def test_find_visible(self, txn_id, expected):
+        index = server_lib.find_visible(self.tmins,
+                                        self.tmaxes,
+                                        self.transactions,
+                                        txn_id)
+        assert index == expected
+
+    def test_find_visible_skips_writer(self):
+        # 3 updates several times without committing.
+        tmins = [1, 3, 3, 3]
+        tmaxes = [0, 0, 0, 0]
+
+        assert server_lib.find_visible(tmins, tmaxes, self.transactions, 3) == 3
+        assert server_lib.find_visible(tmins, tmaxes, self.transactions, 4) == 0
+
+    def test_find_visible_empty(self):
+        assert server_lib.find_visible([], [], self.transactions, 1) == -1
+
+
 class TestServer:
 
     def setup_method(self, method):
         self.server = server_lib.Server()
 
-    def set_up_get_now(self, created_at: float):
-        _get_now_in_seconds = lambda: created_at
-        self.server = server_lib.Server(
-            database=collections.defaultdict(list),
-            _get_now_in_seconds=_get_now_in_seconds)
+    def set_up_next_txn_id(self, created_at: int):
+        # The server from setup_method is still untouched, so only its
+        # counter needs replacing.
+        self.server._next_txn_id = itertools.count(created_at)
 
     def test_get_not_found(self):
         key = 'does_not_found'
 
         assert self.server.get(key) is None
+        assert key not in self.server._database
+
+    def test_get_implicit_snapshot(self):
+        key = FOUND_KEY
+        value = FOUND_VALUE
+        self.server.put(key, value)
+        txn_ids = set(self.server._transactions)
+
+        assert self.server.get(key) == value
+        assert set(self.server._transactions) == txn_ids
+
+    def test_get_cached(self):
+        key = FOUND_KEY
+        self.server.put(key, FOUND_VALUE)
+
+        record = self.server.get_record(key)
+
+        assert self.server._latest[key] is record
+        assert self.server.get_record(key) is record
+
+    def test_put_same_value_shared(self):
+        key = FOUND_KEY
+        # Build equal strings at runtime so they start out as distinct objects.
+        values = [''.join(['f', 'oo']) for _ in range(2)]
+
+        for value in values:
+            self.server.put(key, value)
+
+        records = self.server._database[key].records
+        assert records[-1].value is records[0].value
+
+    def test_put_invalidates_cached(self):
+        key = FOUND_KEY
+        self.server.put(key, FOUND_VALUE)
+        self.server.get(key)
+
+        self.server.put(key, 'foo')
+
+        assert key not in self.server._latest
+        assert self.server.get(key) == 'foo'
 
     def test_get_found(self):
         key = FOUND_KEY
@@ -83,8 +235,8 @@ class TestServer:
     def test_put_key_insert_implicit_transaction(self):
         key = 'not_found'
         value = 'foo'
-        created_at = 12345.0
-        self.set_up_get_now(created_at)
+        created_at = 12345
+        self.set_up_next_txn_id(created_at)
 
         self.server.put(key, value)
 
@@ -92,7 +244,7 @@ class TestServer:
         assert created_at in self.server._transactions
         txn = self.server._transactions[created_at]
         assert txn.created_at == created_at
-        assert txn.state == server_lib.TransactionState.COMMITTED
+        assert txn.state == COMMITTED
 
     def test_put_key_update(self):
         key = FOUND_KEY
@@ -114,89 +266,109 @@ class TestServer:
     def test_delete_not_found(self):
         key = 'not_found'
 
-        with pytest.raises(KeyError):
+        with pytest.raises(KeyError, match=key):
             self.server.delete(key)
+        assert key not in self.server._database
+
+    def test_put_cached_transaction(self):
+        key = 'not_found'
+        value = 'foo'
+
+        txn_id = self.server.start_transaction()
+        txn = self.server.get_transaction(txn_id)
+        self.server.put(key, value, _txn=txn)
+
+        assert self.server.get(key, _txn=txn) == value
+        assert self.server.get(key) is None
+
+    def test_get_transaction_not_found(self):
+        txn_id = 12345
+
+        with pytest.raises(LookupError, match=str(txn_id)):
+            self.server.get_transaction(txn_id)
+
+    @pytest.mark.parametrize('method', ['get', 'delete'])
+    def test_explicit_transaction_not_found(self, method):
+        # Only omitting the transaction ID makes an operation implicit.
+        with pytest.raises(LookupError, match='transaction ID 0 not found'):
+            getattr(self.server, method)(FOUND_KEY, txn_id=0)
 
     def test_start_transaction(self):
-        created_at = 12345.0
-        self.set_up_get_now(created_at)
+        created_at = 12345
+        self.set_up_next_txn_id(created_at)
 
         txn_id = self.server.start_transaction()
 
         assert txn_id == created_at
 
+    def test_start_transaction_unique(self):
+        created_at = 12345
+        self.set_up_next_txn_id(created_at)
+
+        txn_ids = [self.server.start_transaction() for _ in range(3)]
+
+        assert txn_ids == [created_at, created_at + 1, created_at + 2]
+
     def test_commit_transaction(self):
-        created_at = 12345.0
-        self.set_up_get_now(created_at)
+        created_at = 12345
+        self.set_up_next_txn_id(created_at)
 
         txn_id = self.server.start_transaction()
         self.server.commit_transaction(txn_id=txn_id)
 
         assert txn_id in self.server._transactions
         txn = self.server._transactions[txn_id]
-        assert txn.state == server_lib.TransactionState.COMMITTED
+        assert txn.state == COMMITTED
 
     def test_commit_transaction_not_found(self):
-        txn_id = 12345.0
+        txn_id = 12345
 
-        with pytest.raises(LookupError):
+        with pytest.raises(LookupError, match=str(txn_id)):
             self.server.commit_transaction(txn_id=txn_id)
 
-    @pytest.mark.parametrize(
-        'state',
-        [
-            (server_lib.TransactionState.COMMITTED),
-            (server_lib.TransactionState.ABORTED),
-            (server_lib.TransactionState.ABORTED_FAILED),
-        ],
-        ids=[
-            'committed',
-            'aborted',
-            'aborted_failed',
-        ],
-    )
+    @pytest.mark.parametrize('state', FINISHED_STATES, ids=FINISHED_STATE_IDS)
     def test_commit_transaction_bad_state(self, state):
         txn_id = self.server.start_transaction()
         self.server._transactions[txn_id].state = state
 
-        with pytest.raises(ValueError):
+        with pytest.raises(ValueError, match='but actually ' + state.name + '$'):
+            self.server.commit_transaction(txn_id=txn_id)
+
+    def test_commit_transaction_positional(self):
+        txn_id = self.server.start_transaction()
+
+        with pytest.raises(TypeError):
             self.server.commit_transaction(txn_id)
 
     def test_rollback_transaction(self):
-        created_at = 12345.0
-        self.set_up_get_now(created_at)
+        created_at = 12345
+        self.set_up_next_txn_id(created_at)
 
         txn_id = self.server.start_transaction()
         self.server.rollback_transaction(txn_id=txn_id)
 
         assert txn_id in self.server._transactions
         txn = self.server._transactions[txn_id]
-        assert txn.state == server_lib.TransactionState.ABORTED
+        assert txn.state == ABORTED
 
     def test_rollback_transaction_not_found(self):
-        txn_id = 12345.0
+        txn_id = 12345
 
-        with pytest.raises(LookupError):
+        with pytest.raises(LookupError, match=str(txn_id)):
             self.server.rollback_transaction(txn_id=txn_id)
 
-    @pytest.mark.parametrize(
-        'state',
-        [
-            (server_lib.TransactionState.COMMITTED),
-            (server_lib.TransactionState.ABORTED),
-            (server_lib.TransactionState.ABORTED_FAILED),
-        ],
-        ids=[
-            'committed',
-            'aborted',
-            'aborted_failed',
-        ],
-    )
+    @pytest.mark.parametrize('state', FINISHED_STATES, ids=FINISHED_STATE_IDS)
     def test_rollback_transaction_bad_state(self, state):
         txn_id = self.server.start_transaction()
         self.server._transactions[txn_id].state = state
 
-        with pytest.raises(ValueError):
+        with pytest.raises(ValueError, match='but actually ' + state.name + '$'):
+            self.server.rollback_transaction(txn_id=txn_id)
+
+    def test_rollback_transaction_positional(self):
+        txn_id = self.server.start_transaction()
+
+        with pytest.raises(TypeError):
             self.server.rollback_transaction(txn_id)
 
 
@@ -295,6 +467,26 @@ class TestIntegration:
         assert record.value == updated
         assert record.transaction_min == alice
 
+    def test_many_uncommitted_versions(self):
+        server = server_lib.Server()
+        key = 'name'
+        value = 'alice'
+
+        # All users can see committed inserts.
+        server.put(key, value)
+
+        # Other users skip every version from an uncommitted writer.
+        alice = server.start_transaction()
+        for i in range(10):
+            server.put(key, '{}_{}'.format(value, i), txn_id=alice)
+
+        bob = server.start_transaction()
+        assert server.get(key, txn_id=bob) == value
+        assert server.get(key, txn_id=alice) == '{}_9'.format(value)
+
+        # Rewrites replace the writer's own version.
+        assert len(server._database[key]) == 3
+
     def test_aborted(self):
         server = server_lib.Server()
         key_1 = 'name_1'
@@ -328,7 +520,7 @@ class TestIntegration:
         # No users can see aborted writes.
         server.rollback_transaction(txn_id=alice)
 
-        with pytest.raises(ValueError):
+        with pytest.raises(ValueError, match='but actually ABORTED$'):
             server.get_record(key_1, txn_id=alice)
 
         bob_record = server.get_record(key_1, txn_id=bob)
@@ -339,6 +531,144 @@ class TestIntegration:
         bob_record = server.get_record(key_2, txn_id=bob)
         assert bob_record is None
 
+    def test_latest_after_commit(self):
+        server = server_lib.Server()
+        key = 'name'
+        value = 'alice'
+        updated = 'alice_updated'
+
+        server.put(key, value)
+        assert server.get(key) == value
+
+        # Reads outside a transaction see the update as soon as it commits,
+        # even though nothing writes to the key in between.
+        alice = server.start_transaction()
+        server.put(key, updated, txn_id=alice)
+        assert server.get(key) == value
+        server.commit_transaction(txn_id=alice)
+        assert server.get(key) == updated
+
+        # The same goes for deletes.
+        bob = server.start_transaction()
+        server.delete(key, txn_id=bob)
+        assert server.get(key) == updated
+        server.commit_transaction(txn_id=bob)
+        assert server.get(key) is None
+
+    def test_back_to_back_transactions(self):
+        server = server_lib.Server()
+        key = 'name'
+
+        # Transactions started back to back still get distinct, ordered IDs.
+        alice = server.start_transaction()
+        bob = server.start_transaction()
+        assert alice < bob
+
+        # Users only see their own uncommitted writes.
+        server.put(key, 'alice', txn_id=alice)
+        server.put(key, 'bob', txn_id=bob)
+        assert server.get(key, txn_id=alice) == 'alice'
+        assert server.get(key, txn_id=bob) == 'bob'
+        assert server.get(key) is None
+
+    def test_compact_aborted(self):
+        server = server_lib.Server()
+        key = 'name'
+        value = 'alice'
+
+        server.put(key, value)
+        for _ in range(server_lib.COMPACT_THRESHOLD):
+            alice = server.start_transaction()
+            server.put(key, 'aborted', txn_id=alice)
+            server.rollback_transaction(txn_id=alice)
+
+        server.put(key, 'bob')
+
+        # Without compaction each aborted update would leave two versions.
+        chain = server._database[key]
+        assert len(chain) < 2 * server_lib.COMPACT_THRESHOLD
+        assert server.get(key) == 'bob'
+
+    def test_higher_transaction_id_wins(self):
+        server = server_lib.Server()
+        key = 'name'
+
+        # An older transaction commits its update after a newer one did.
+        alice = server.start_transaction()
+        server.put(key, 'alice', txn_id=alice)
+        server.put(key, 'bob')
+        server.commit_transaction(txn_id=alice)
+
+        # The newer transaction's version still shadows it.
+        assert server.get(key) == 'bob'
+        carol = server.start_transaction()
+        assert server.get(key, txn_id=carol) == 'bob'
+
+    def test_vacuum(self):
+        server = server_lib.Server()
+        key = 'name'
+
+        # Only the newest committed version is visible to anyone.
+        for value in ['alice', 'bob', 'carol']:
+            server.put(key, value)
+        server.vacuum()
+
+        chain = server._database[key]
+        assert [record.value for record in chain.records] == ['carol']
+        assert list(server._transactions) == chain.tmins
+        assert server.get(key) == 'carol'
+
+    def test_vacuum_active_snapshot(self):
+        server = server_lib.Server()
+        key = 'name'
+
+        # Versions stay as long as an active transaction can still see them.
+        server.put(key, 'alice')
+        bob = server.start_transaction()
+        server.put(key, 'bob')
+        server.vacuum()
+
+        assert server.get(key, txn_id=bob) == 'alice'
+        assert server.get(key) == 'bob'
+
+        server.commit_transaction(txn_id=bob)
+        server.vacuum()
+
+        chain = server._database[key]
+        assert [record.value for record in chain.records] == ['bob']
+
+    def test_vacuum_deleted(self):
+        server = server_lib.Server()
+        key = 'name'
+
+        server.put(key, 'alice')
+        server.delete(key)
+        server.vacuum()
+
+        assert key not in server._database
+        assert not server._transactions
+        assert server.get(key) is None
+
+    def test_vacuum_keeps_ids(self):
+        server = server_lib.Server()
+
+        alice = server.start_transaction()
+        server.commit_transaction(txn_id=alice)
+        server.vacuum()
+
+        assert server.start_transaction() == alice + 1
+
+    def test_vacuum_opportunistic(self):
+        server = server_lib.Server()
+        key = 'name'
+
+        for i in range(2 * server_lib.VACUUM_THRESHOLD):
+            server.put(key, str(i))
+
+        # Without vacuuming every write would keep its transaction.
+        assert len(server._transactions) < 2 * server_lib.VACUUM_THRESHOLD
+        assert server.get(key) == str(2 * server_lib.VACUUM_THRESHOLD - 1)
+
     def test_failed_delete(self):
         server = server_lib.Server()
         key = 'name'
@@ -356,4 +686,236 @@ class TestIntegration:
         bob_record = server.get(key, txn_id=bob)
         assert bob_record is None
 
-        assert server._transactions[alice].state == server_lib.TransactionState.ABORTED_FAILED
\ No newline at end of file
+        assert server._transactions[alice].state == ABORTED_FAILED
+
+
+class TestWebServer:
+
+    @pytest.mark.parametrize(
+        'output',
+        [
+            ({'status': 'Ok'}),
+            ({'status': 'Ok', 'result': 'caf\u00e9 "quoted"'}),
+            ({'status': 'Error', 'mesg': 'key "name" not found'}),
+        ],
+        ids=[
+            'status',
+            'result',
+            'mesg',
+        ],
+    )
+    def test_format(self, output):
+        formatted = server_lib.WebServer.format(output)
+
+        assert formatted.endswith(b'\n')
+        assert formatted == (json.dumps(output) + '\n').encode()
+
+    @pytest.mark.parametrize(
+        'request_, expected',
+        [
+            (b'GET name', ('GET', 'name', 0)),
+            (b'PUT name 10', ('PUT', 'name', 10)),
+            (b'START', ('START', '', 0)),
+        ],
+        ids=[
+            'key',
+            'length',
+            'command',
+        ],
+    )
+    def test_parse(self, request_, expected):
+        request = server_lib.WebServer.parse(request_)
+
+        assert request is not None
+        assert (request.command, request.key, request.length) == expected
+
+    def test_parse_value(self):
+        request = server_lib.WebServer.parse(b'PUT name 11')
+        assert request is not None
+
+        request = server_lib.WebServer.parse_value(request, b'first\nlast\n')
+
+        assert request is not None
+        assert request.value == 'first\nlast'
+
+    @pytest.mark.parametrize(
+        'value',
+        [
+            (b'first last'),
+            (b'\xff\n'),
+        ],
+        ids=[
+            'missing_terminator',
+            'invalid_encoding',
+        ],
+    )
+    def test_parse_value_invalid(self, value):
+        request = server_lib.WebServer.parse(b'PUT name 10')
+        assert request is not None
+
+        assert server_lib.WebServer.parse_value(request, value) is None
+
+    @pytest.mark.parametrize(
+        'request_',
+        [
+            (b'FOO name'),
+            (b'PUT name'),
+            (b'PUT name duy'),
+            (b'PUT name 0'),
+            (b'DELETE'),
+        ],
+        ids=[
+            'unknown_command',
+            'put_missing_length',
+            'put_invalid_length',
+            'put_empty_value',
+            'delete_missing_key',
+        ],
+    )
+    def test_parse_invalid(self, request_):
+        assert server_lib.WebServer.parse(request_) is None
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.written = []
+        self.is_reading = True
+        self.is_closed = False
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writelines(self, list_of_data):
+        self.write(b''.join(list_of_data))
+
+    def close(self):
+        self.is_closed = True
+
+    def pause_reading(self):
+        self.is_reading = False
+
+    def resume_reading(self):
+        self.is_reading = True
+
+
+class TestConnection:
+
+    def setup_method(self, method):
+        self.transport = FakeTransport()
+        self.connection = server_lib.Connection(server_lib.WebServer())
+        self.connection.connection_made(self.transport)
+
+    def get_responses(self):
+        written = b''.join(self.transport.written)
+        return [json.loads(line) for line in written.splitlines()]
+
+    def test_pipelined(self):
+        self.connection.data_received(b'GET intro\nGET not_found\n')
+
+        assert len(self.transport.written) == 1
+        assert self.get_responses() == [
+            {'status': 'Ok', 'result': 'Hello, World!'},
+            {'status': 'Error', 'mesg': 'key "not_found" not found'},
+        ]
+
+    def test_partial_request(self):
+        self.connection.data_received(b'PUT name 7\nduy')
+        assert self.transport.written == []
+
+        self.connection.data_received(b' duy\nGET na')
+        self.connection.data_received(b'me\n')
+
+        assert self.get_responses() == [
+            {'status': 'Ok'},
+            {'status': 'Ok', 'result': 'duy duy'},
+        ]
+
+    def test_empty_request(self):
+        self.connection.data_received(b'\n')
+
+        assert self.get_responses() == [
+            {'status': 'Error', 'mesg': 'invalid request ""'},
+        ]
+
+    def test_invalid_encoding(self):
+        self.connection.data_received(b'\xff\n')
+
+        assert self.get_responses() == [
+            {'status': 'Error', 'mesg': 'invalid request "\ufffd"'},
+        ]
+        assert not self.transport.is_closed
+
+    def test_request_too_long(self):
+        self.connection.data_received(b'GET intro\n')
+        for _ in range(server_lib.MAX_LINE_LENGTH // 1024 + 1):
+            self.connection.data_received(b'a' * 1024)
+
+        assert self.get_responses() == [
+            {'status': 'Ok', 'result': 'Hello, World!'},
+            {'status': 'Error', 'mesg': 'request too long'},
+        ]
+        assert self.transport.is_closed
+        assert not self.connection.buffer
+
+    def test_value_too_long(self):
+        request = 'PUT name {}\n'.format(server_lib.MAX_VALUE_LENGTH + 1)
+
+        self.connection.data_received(request.encode())
+
+        assert self.get_responses() == [
+            {'status': 'Error', 'mesg': 'value too long'},
+        ]
+        assert self.transport.is_closed
+
+    def test_rollback_after_vacuum(self):
+        self.connection.data_received(b'START\nDELETE not_found\n')
+        # The failed transaction wrote nothing, so the vacuum forgets it.
+        self.connection.web_server.server.vacuum()
+        self.connection.data_received(b'ROLLBACK\n')
+
+        assert self.get_responses()[-1] == {
+            'status': 'Error',
+            'mesg': 'expected state for transaction ID 2 to be ACTIVE but actually ABORTED_FAILED',
+        }
+
+    def test_connection_lost(self):
+        self.connection.data_received(b'START\nPUT name 5\nalice\n')
+        txn = self.connection.session['txn']
+
+        self.connection.connection_lost(None)
+
+        assert txn.state == ABORTED
+        assert self.connection.session['txn'] is None
+        assert self.connection.web_server.server.get('name') is None
+
+    def test_backpressure(self):
+        self.connection.pause_writing()
+        assert not self.transport.is_reading
+
+        self.connection.resume_writing()
+        assert self.transport.is_reading
+
+
+class TestRun:
+
+    async def answer(self):
+        return 42
+
+    def test_without_uvloop(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, 'uvloop', None)
+
+        assert server_lib.run(self.answer()) == 42
+
+    def test_uvloop_without_run(self, monkeypatch):
+        # uvloop before 0.18 only has install.
+        installed = []
+        uvloop = types.ModuleType('uvloop')
+        uvloop.install = lambda: installed.append(True)
+        monkeypatch.setitem(sys.modules, 'uvloop', uvloop)
+
+        assert server_lib.run(self.answer()) == 42
+        assert installed == [True]